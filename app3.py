@@ -1,9 +1,10 @@
-# app.py - Teacher-controlled QR attendance with Teacher PIN required for student submit
-from flask import Flask, request, session, redirect, url_for, render_template_string, make_response
-import os, io, base64, sqlite3, hashlib
-from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
+# app3.py - Teacher-controlled QR attendance with Teacher PIN required for student submit
+from flask import Flask, request, session, redirect, url_for, send_file, g
+import os, re, sqlite3, hashlib, hmac, base64, time, threading, queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from datetime import datetime
-import qrcode, pandas as pd
+import qrcode, xlsxwriter
 
 # --------- CONFIG ----------
 SECRET_KEY = os.environ.get("SECRET_KEY", "dev-secret-key")
@@ -13,15 +14,108 @@ ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin123")
 TEACHER_PIN = os.environ.get("TEACHER_PIN", "0000")
 QR_TTL_SECONDS = int(os.environ.get("QR_TTL_SECONDS", "600"))
 BASE_URL = os.environ.get("BASE_URL", "http://127.0.0.1:5000")
+SUBMIT_LINK_PREFIX = f"{BASE_URL}/submit?token="
 DATABASE = os.path.join(os.path.dirname(__file__), "attendance.db")
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports")
+# quiet period after the last write before the export file is rebuilt
+EXPORT_DEBOUNCE_SECONDS = float(os.environ.get("EXPORT_DEBOUNCE_SECONDS", "2"))
+# how often expired slot tokens are removed from the settings table
+TOKEN_CLEANUP_SECONDS = int(os.environ.get("TOKEN_CLEANUP_SECONDS", "900"))
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
-serializer = URLSafeTimedSerializer(QR_SECRET)
+_QR_KEY = QR_SECRET.encode()
+# secrets as bytes once, for the constant-time comparisons in the routes
+_ADMIN_PASSWORD_B = ADMIN_PASSWORD.encode()
+_TEACHER_PIN_B = TEACHER_PIN.encode()
 
 # --------- DB ----------
+# hot statements live in constants so every call sends identical SQL text
+# and hits the connection's prepared-statement cache
+STATEMENT_CACHE_SIZE = 256
+_GET_SETTING_SQL = "SELECT value FROM settings WHERE key=?"
+# attendance writes bump counter rows in the same transaction, so every
+# worker can tell from the database whether derived data is stale:
+# data_version moves on any change, clear_version only when rows are deleted
+_DATA_VERSION_KEY = "data_version"
+_CLEAR_VERSION_KEY = "clear_version"
+_BUMP_VERSION_SQL = "INSERT INTO settings (key,value) VALUES (?,'1') ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1"
+_INSERT_SQL = "INSERT OR IGNORE INTO attendance (student_name, roll, slot, timestamp, device_cid, ip, user_agent) VALUES (?,?,?,?,?,?,?)"
+
+# Reads go through a pool of long-lived read-only connections so SQLite's
+# page cache stays warm and WAL lets them run alongside the writer; at most
+# POOL_MAX_CONNECTIONS are open, extra callers wait. Every write goes
+# through the single writer thread below (execute_write).
+POOL_MAX_CONNECTIONS = 8
+_pool_idle = queue.LifoQueue()
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
+def _connect(read_only=False):
+    # every connection (pooled or the writer's) gets the same setup once
+    conn = sqlite3.connect(DATABASE, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-40000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
+    return conn
+
+def acquire_conn():
+    _pool_slots.acquire()
+    try:
+        return _pool_idle.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return _connect(read_only=True)
+    except Exception:
+        _pool_slots.release()
+        raise
+
+def release_conn(conn):
+    # drop anything a failed request left uncommitted before reuse
+    conn.rollback()
+    _pool_idle.put(conn)
+    _pool_slots.release()
+
+def get_db():
+    # one pooled connection per request/app context, returned in close_db
+    db = g.get("_db")
+    if db is None:
+        db = g._db = acquire_conn()
+    return db
+
+def fetch_rows(sql, params=()):
+    # plain tuples straight from the cursor; callers never need more
+    return get_db().execute(sql, params).fetchall()
+
+def fetch_one(sql, params=()):
+    return get_db().execute(sql, params).fetchone()
+
+def read_version(conn, key=_DATA_VERSION_KEY):
+    row = conn.execute(_GET_SETTING_SQL, (key,)).fetchone()
+    return int(row[0]) if row else 0
+
+def data_version():
+    # always read fresh: this is what the per-process caches are checked against
+    return read_version(get_db())
+
+def clear_version():
+    return read_version(get_db(), _CLEAR_VERSION_KEY)
+
+@app.teardown_appcontext
+def close_db(exc):
+    db = g.pop("_db", None)
+    if db is not None:
+        release_conn(db)
+
 def init_db():
     conn = sqlite3.connect(DATABASE)
+    # WAL is persistent in the db file: readers no longer block the writer
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     c.execute("""
         CREATE TABLE IF NOT EXISTS attendance (
@@ -35,121 +129,468 @@ def init_db():
             user_agent TEXT
         )
     """)
+    # one submission per device per slot; also serves the duplicate lookup.
+    # Databases from before the index can hold duplicates left by the old
+    # check-then-insert race: keep the first submission of each.
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='uq_attendance_slot_device'").fetchone():
+        c.execute("DELETE FROM attendance WHERE device_cid IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM attendance GROUP BY slot, device_cid)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_attendance_slot_device ON attendance(slot, device_cid)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_attendance_slot_ts ON attendance(slot, timestamp DESC)")
+    # covers the unfiltered admin listing (id is the rowid, always included)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_attendance_ts_cover ON attendance(timestamp DESC, slot, student_name, roll)")
     c.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT
         )
     """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS tokens (
-            token TEXT PRIMARY KEY,
-            slot TEXT,
-            created_at TEXT
-        )
-    """)
     conn.commit()
     conn.close()
 
+# Settings (incl. each slot's current token) only change when the teacher acts, so lookups are
+# cached in-process. A write drops the key here, but other workers only see it once their
+# copy expires, so LOOKUP_CACHE_TTL is kept short: it bounds how long a worker can serve
+# an old value. Each drop bumps the key's generation, and a lookup that raced a drop
+# does not put back the value it read before the write.
+LOOKUP_CACHE_TTL = 2
+_lookup_cache = {}
+_lookup_gen = {}
+_lookup_lock = threading.RLock()
+_MISSING = object()
+
+def _cache_get(key):
+    # returns (value or _MISSING, generation to hand back to _cache_put)
+    with _lookup_lock:
+        hit = _lookup_cache.get(key)
+        gen = _lookup_gen.get(key, 0)
+    if hit is None or hit[0] < time.monotonic():
+        return _MISSING, gen
+    return hit[1], gen
+
+def _cache_put(key, value, gen):
+    with _lookup_lock:
+        if _lookup_gen.get(key, 0) == gen:
+            _lookup_cache[key] = (time.monotonic() + LOOKUP_CACHE_TTL, value)
+
+def _cache_drop(key):
+    with _lookup_lock:
+        _lookup_gen[key] = _lookup_gen.get(key, 0) + 1
+        _lookup_cache.pop(key, None)
+
 def get_setting(key):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+    value, gen = _cache_get(("setting", key))
+    if value is _MISSING:
+        row = fetch_one(_GET_SETTING_SQL, (key,))
+        value = row[0] if row else None
+        _cache_put(("setting", key), value, gen)
+    return value
 
 def set_setting(key, value):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("INSERT INTO settings (key,value) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
-    conn.commit()
-    conn.close()
+    execute_write("INSERT INTO settings (key,value) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+    _cache_drop(("setting", key))
 
 def clear_setting(key):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("DELETE FROM settings WHERE key=?", (key,))
-    conn.commit()
-    conn.close()
+    execute_write("DELETE FROM settings WHERE key=?", (key,))
+    _cache_drop(("setting", key))
 
+# Tokens are self-validating (signed, with their expiry inside), so no token
+# table is needed: the slot's current token is a setting, which also keeps
+# it behind the lookup cache on the submit path.
 def store_token(token, slot):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO tokens (token,slot,created_at) VALUES (?,?,?)", (token, slot, datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    old = get_setting(f"token:{slot}")
+    set_setting(f"token:{slot}", token)
+    _qr_cache.pop(slot, None)
+    # only this slot's render is obsolete; other slots keep theirs
+    if old:
+        _qr_jobs.pop(old, None)
 
 def get_token_for_slot(slot):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("SELECT token, created_at FROM tokens WHERE slot=?", (slot,))
-    row = c.fetchone()
-    conn.close()
-    return row if row else None
+    return get_setting(f"token:{slot}")
 
-def delete_token(token):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("DELETE FROM tokens WHERE token=?", (token,))
-    conn.commit()
-    conn.close()
+def purge_expired_tokens():
+    # expiry lives inside the token, so it is checked here rather than in SQL
+    conn = acquire_conn()
+    try:
+        rows = conn.execute("SELECT key, value FROM settings WHERE key LIKE 'token:%'").fetchall()
+    finally:
+        release_conn(conn)
+    purged = 0
+    for key, token in rows:
+        if token_expiry(token):
+            continue
+        # only if unchanged: Generate may have stored a new token since the read
+        purged += execute_write("DELETE FROM settings WHERE key=? AND value=?", (key, token))
+        _cache_drop(("setting", key))
+    return purged
+
+def start_token_cleanup():
+    def run():
+        try:
+            removed = purge_expired_tokens()
+            if removed:
+                app.logger.info("removed %d expired QR token(s)", removed)
+        except Exception:
+            app.logger.exception("expired token cleanup failed")
+        start_token_cleanup()
+    timer = threading.Timer(TOKEN_CLEANUP_SECONDS, run)
+    timer.daemon = True
+    timer.start()
+
+# rendered record views for one data version (see data_version); a write
+# in any worker moves the version on and the whole cache is dropped. Keys
+# come from the query string, so at most VIEW_CACHE_MAX_ENTRIES are kept.
+VIEW_CACHE_MAX_ENTRIES = 64
+_view_cache = {}
+_view_version = None
+_view_lock = threading.Lock()
+
+def view_cache_get(version, key):
+    global _view_version
+    with _view_lock:
+        if _view_version != version:
+            _view_cache.clear()
+            _view_version = version
+        return _view_cache.get(key)
+
+def view_cache_put(version, key, html):
+    with _view_lock:
+        if _view_version == version and len(_view_cache) < VIEW_CACHE_MAX_ENTRIES:
+            _view_cache[key] = html
+
+# slot -> device_cids known to have submitted, so repeat attempts skip the
+# writer entirely. Per process only; the unique index stays the source of
+# truth. Entries are only valid for one clear_version, so a clear in any
+# worker empties it everywhere.
+_seen = {}
+_seen_version = None
+_seen_lock = threading.Lock()
+
+def seen_submission(slot, device_cid, version):
+    global _seen_version
+    with _seen_lock:
+        if _seen_version != version:
+            _seen.clear()
+            _seen_version = version
+        return device_cid in _seen.get(slot, ())
+
+def remember_submission(slot, device_cid, version):
+    with _seen_lock:
+        if _seen_version == version:
+            _seen.setdefault(slot, set()).add(device_cid)
+
+def forget_submissions(slot=None):
+    with _seen_lock:
+        if slot is None:
+            _seen.clear()
+        else:
+            _seen.pop(slot, None)
+
+# All writes are run by one background thread that commits whatever
+# arrived within WRITE_BATCH_WINDOW in a single transaction (one fsync per
+# batch instead of per statement). Each caller waits for its own rowcount.
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WINDOW = 0.05
+_write_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+# how long a caller waits for the writer before giving up on its statement
+WRITE_TIMEOUT_SECONDS = 30
+
+def _writer_loop():
+    global _writer
+    conn = None
+    try:
+        while True:
+            batch = [_write_queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WINDOW
+            while len(batch) < WRITE_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(_write_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                # (re)connect here so a failure fails this batch and the
+                # next batch retries, instead of killing the thread
+                if conn is None:
+                    conn = _connect()
+                with conn:
+                    for item in batch:
+                        item["rowcount"] = conn.execute(item["sql"], item["params"]).rowcount
+                        if item["rowcount"]:
+                            for key in item["bump"]:
+                                conn.execute(_BUMP_VERSION_SQL, (key,))
+            except Exception as e:
+                # the whole transaction rolled back: fail every statement in it
+                for item in batch:
+                    item["error"] = e
+            for item in batch:
+                item["done"].set()
+    finally:
+        # let the next execute_write start a fresh writer
+        with _writer_lock:
+            _writer = None
+
+def _ensure_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="attendance-writer", daemon=True)
+            _writer.start()
+
+def execute_write(sql, params=(), bump=()):
+    # bump: version keys to increment in the same transaction if any row changed
+    if _writer is None:
+        _ensure_writer()
+    item = {"sql": sql, "params": params, "bump": bump, "done": threading.Event()}
+    _write_queue.put(item)
+    if not item["done"].wait(WRITE_TIMEOUT_SECONDS):
+        raise TimeoutError("database writer did not respond")
+    if "error" in item:
+        raise item["error"]
+    return item["rowcount"]
 
 def insert_record(name, roll, slot, device_cid, ip, ua):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute("INSERT INTO attendance (student_name, roll, slot, timestamp, device_cid, ip, user_agent) VALUES (?,?,?,?,?,?,?)",
-              (name, roll, slot, datetime.utcnow().isoformat(), device_cid, ip, ua))
-    conn.commit()
-    conn.close()
+    version = clear_version()
+    if seen_submission(slot, device_cid, version):
+        return 0
+    inserted = execute_write(_INSERT_SQL, (name, roll, slot, now_iso(), device_cid, ip, ua),
+                             bump=(_DATA_VERSION_KEY,))
+    # inserted or ignored as a duplicate: either way the row now exists
+    remember_submission(slot, device_cid, version)
+    if inserted:
+        schedule_export()
+    return inserted
+
+VIEW_COLS = ["id","student_name","roll","slot","timestamp"]
+VIEW_PAGE_SIZE = 100
+VIEW_MAX_PAGE_SIZE = 500
+# keeps LIMIT/OFFSET well inside SQLite's 64-bit integers for any ?page=
+VIEW_MAX_PAGE = 1_000_000
+
+def list_records(slot=None, limit=VIEW_PAGE_SIZE, offset=0):
+    # newest rows for the admin table; filtering and paging happen in SQL.
+    # timestamps are whole seconds, so id breaks ties to keep pages stable
+    if slot:
+        return fetch_rows("SELECT id, student_name, roll, slot, timestamp FROM attendance WHERE slot=? ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?", (slot, limit, offset))
+    return fetch_rows("SELECT id, student_name, roll, slot, timestamp FROM attendance ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?", (limit, offset))
 
-def query_records(slot=None, admin_view=False):
-    conn = sqlite3.connect(DATABASE)
+EXPORT_COLS = ["id","student_name","roll","slot","timestamp","device_cid","ip","user_agent"]
+
+def iter_records(conn):
+    # cursor is iterated lazily so the export never holds the whole table
     c = conn.cursor()
-    if admin_view:
-        if slot:
-            c.execute("SELECT id, student_name, roll, slot, timestamp FROM attendance WHERE slot=? ORDER BY timestamp DESC", (slot,))
-        else:
-            c.execute("SELECT id, student_name, roll, slot, timestamp FROM attendance ORDER BY timestamp DESC")
-        rows = c.fetchall()
-        cols = ["id","student_name","roll","slot","timestamp"]
-    else:
-        if slot:
-            c.execute("SELECT id, student_name, roll, slot, timestamp, device_cid, ip, user_agent FROM attendance WHERE slot=? ORDER BY timestamp DESC", (slot,))
-        else:
-            c.execute("SELECT id, student_name, roll, slot, timestamp, device_cid, ip, user_agent FROM attendance ORDER BY timestamp DESC")
-        rows = c.fetchall()
-        cols = ["id","student_name","roll","slot","timestamp","device_cid","ip","user_agent"]
-    conn.close()
-    return pd.DataFrame(rows, columns=cols) if rows else pd.DataFrame(columns=cols)
+    c.execute("SELECT id, student_name, roll, slot, timestamp, device_cid, ip, user_agent FROM attendance ORDER BY timestamp DESC, id DESC")
+    return c
 
 def clear_records(all_records=False, slot=None):
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
     if all_records:
-        c.execute("DELETE FROM attendance")
+        execute_write("DELETE FROM attendance", bump=(_DATA_VERSION_KEY, _CLEAR_VERSION_KEY))
     elif slot:
-        c.execute("DELETE FROM attendance WHERE slot=?", (slot,))
-    conn.commit()
-    conn.close()
+        execute_write("DELETE FROM attendance WHERE slot=?", (slot,), bump=(_DATA_VERSION_KEY, _CLEAR_VERSION_KEY))
+    schedule_export()
+    if all_records:
+        forget_submissions()
+    elif slot:
+        forget_submissions(slot)
 
 # --------- UTIL ----------
-def make_device_cid(req):
-    ua = req.headers.get("User-Agent", "")
-    ip = req.remote_addr or ""
-    return hashlib.sha256(f"{ip}|{ua}".encode()).hexdigest()
+_ts_cache = [0, ""]
+
+def now_iso():
+    # second resolution; inserts within the same second share one string
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        _ts_cache[:] = [t, datetime.utcfromtimestamp(t).isoformat()]
+    return _ts_cache[1]
+
+# keyed blake2s: a short stable id, not reversible without SECRET_KEY.
+# The keyed state is built once; each request hashes a copy of it.
+_CID_BASE = hashlib.blake2s(digest_size=16, key=SECRET_KEY.encode()[:32])
+
+def make_device_cid(ip, ua):
+    h = _CID_BASE.copy()
+    h.update(f"{ip}|{ua}".encode())
+    return h.hexdigest()
+
+# QR token: base64url("<slot>.<expiry epoch>|" + 12-byte HMAC-blake2s tag)
+_TAG_LEN = 12
+
+class BadToken(Exception):
+    pass
+
+class TokenExpired(BadToken):
+    pass
+
+def _token_tag(body):
+    return hmac.new(_QR_KEY, body, hashlib.blake2s).digest()[:_TAG_LEN]
 
 def make_token(slot):
-    return serializer.dumps({"slot": slot})
+    body = f"{slot}.{int(time.time()) + QR_TTL_SECONDS}".encode()
+    return base64.urlsafe_b64encode(body + b"|" + _token_tag(body)).decode("ascii").rstrip("=")
 
 def decode_token(token):
-    return serializer.loads(token, max_age=QR_TTL_SECONDS)
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except ValueError:
+        raise BadToken("malformed token")
+    body, sep, tag = raw[:-_TAG_LEN - 1], raw[-_TAG_LEN - 1:-_TAG_LEN], raw[-_TAG_LEN:]
+    if sep != b"|" or not hmac.compare_digest(tag, _token_tag(body)):
+        raise BadToken("bad signature")
+    slot, _, exp = body.decode().rpartition(".")
+    if int(exp) <= time.time():
+        raise TokenExpired("token expired")
+    return {"slot": slot, "exp": int(exp)}
+
+def token_expiry(token):
+    # None when the token is missing, invalid or already expired
+    if not token:
+        return None
+    try:
+        return decode_token(token)["exp"]
+    except BadToken:
+        return None
+
+# slot -> (token, qr_svg); the SVG is only rebuilt when the slot's token changes
+_qr_cache = {}
+
+# token -> Future rendering its SVG; QR work runs here, not on request threads
+_qr_exec = ThreadPoolExecutor(max_workers=2, thread_name_prefix="qr")
+_qr_jobs = {}
+
+def render_qr_svg(link):
+    # level L (7% recovery) is plenty for a code shown on a screen and keeps
+    # the matrix, and so the SVG, smaller than the default level M
+    q = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L)
+    q.add_data(link)
+    q.make(fit=True)
+    # straight from the module matrix: one path segment per horizontal run
+    # of dark modules instead of qrcode's per-module image drawer
+    matrix = q.get_matrix()
+    size = len(matrix)
+    parts = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                parts.append(f"M{start} {y}h{x - start}v1h{start - x}z")
+            else:
+                x += 1
+    return (f"<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 {size} {size}' shape-rendering='crispEdges'>"
+            f"<path d='{''.join(parts)}'/></svg>")
+
+def start_qr(token, link):
+    job = _qr_jobs.get(token)
+    if job is None:
+        job = _qr_jobs[token] = _qr_exec.submit(render_qr_svg, link)
+    return job
+
+def qr_svg(slot, token, link):
+    # None while the background render is still running
+    cached = _qr_cache.get(slot)
+    if cached and cached[0] == token:
+        return cached[1]
+    job = start_qr(token, link)
+    if not job.done():
+        return None
+    _qr_jobs.pop(token, None)
+    svg = job.result()
+    _qr_cache[slot] = (token, svg)
+    return svg
+
+# --------- EXPORT ----------
+# One xlsx per data version, attendance-<version>.xlsx, shared by all
+# workers. A background thread rebuilds it after writes settle down, and
+# /admin/export builds it on demand when no file matches the current version.
+# Only names this code writes are ever removed: attendance-<n>.xlsx and
+# its attendance-<n>.xlsx.<pid>.part temp file.
+_EXPORT_FILE_RE = re.compile(r"attendance-(\d+)\.xlsx")
+_EXPORT_PART_RE = re.compile(r"attendance-\d+\.xlsx\.\d+\.part")
+_export_lock = threading.RLock()
+_export_wake = threading.Event()
+_export_thread = None
+_export_thread_lock = threading.Lock()
+
+def cleanup_exports(older_than=None):
+    # None: startup, remove every export and leftover .part file
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for name in os.listdir(EXPORT_DIR):
+        m = _EXPORT_FILE_RE.fullmatch(name)
+        if older_than is None:
+            stale = m or _EXPORT_PART_RE.fullmatch(name)
+        else:
+            stale = m and int(m.group(1)) < older_than
+        if stale:
+            try:
+                os.remove(os.path.join(EXPORT_DIR, name))
+            except OSError:
+                pass  # still open for a download on Windows; leave it behind
+
+def build_export():
+    conn = acquire_conn()
+    try:
+        # one read snapshot for both the version and the rows
+        conn.execute("BEGIN")
+        version = read_version(conn)
+        path = os.path.join(EXPORT_DIR, f"attendance-{version}.xlsx")
+        # only serialises builds within this process (they share the .part
+        # name); nothing on the request path waits on it
+        with _export_lock:
+            if not os.path.exists(path):
+                os.makedirs(EXPORT_DIR, exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.part"
+                try:
+                    # constant_memory flushes each row to a temp file as it is written
+                    wb = xlsxwriter.Workbook(tmp, {"constant_memory": True})
+                    ws = wb.add_worksheet()
+                    ws.write_row(0, 0, EXPORT_COLS)
+                    for i, row in enumerate(iter_records(conn), start=1):
+                        ws.write_row(i, 0, row)
+                    wb.close()
+                    os.replace(tmp, path)
+                except Exception:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+                    raise
+    finally:
+        release_conn(conn)
+    cleanup_exports(older_than=version)
+    return path
+
+def _export_loop():
+    while True:
+        _export_wake.wait()
+        # debounce: rebuild only once no write arrived for a full quiet period
+        while True:
+            _export_wake.clear()
+            if not _export_wake.wait(EXPORT_DEBOUNCE_SECONDS):
+                break
+        try:
+            build_export()
+        except Exception:
+            app.logger.exception("background export build failed")
+
+def schedule_export():
+    global _export_thread
+    with _export_thread_lock:
+        if _export_thread is None:
+            _export_thread = threading.Thread(target=_export_loop, name="attendance-export", daemon=True)
+            _export_thread.start()
+    _export_wake.set()
 
 # --------- TEMPLATES ----------
 BASE_HTML = """
 <!doctype html><html lang='en'><head><meta charset='utf-8'/><meta name='viewport' content='width=device-width,initial-scale=1'/>
 <link href='https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css' rel='stylesheet'/>
-<style>body{background:#0f1724;color:#e6eef8} .card{background:#0b1320;border:none} .qr-img{max-width:230px;background:#fff;padding:8px;border-radius:8px} a{color:#7dd3fc}</style>
+<style>body{background:#0f1724;color:#e6eef8} .card{background:#0b1320;border:none} .qr-img{max-width:230px;background:#fff;padding:8px;border-radius:8px} .qr-img svg{display:block;width:100%;height:auto} a{color:#7dd3fc}</style>
 </head><body>
 <div class='container py-4'>
   <div class='d-flex justify-content-between mb-3'>
@@ -159,7 +600,7 @@ BASE_HTML = """
       <a href='/admin/login' class='btn btn-sm btn-outline-light ms-2'>Teacher</a>
     </div>
   </div>
-  {{content | safe}}
+  {% block content %}{% endblock %}
 </div></body></html>
 """
 
@@ -205,12 +646,28 @@ ADMIN_DASH_HTML = """
     </form>
     {% if token_info %}
       <div class='mt-3 d-flex gap-3'>
-        <img src='data:image/png;base64,{{token_info.qr_b64}}' class='qr-img' />
+        {% if token_info.qr_svg %}
+        <div class='qr-img'>{{token_info.qr_svg | safe}}</div>
+        {% else %}
+        <div class='qr-img text-dark small' id='qr-pending'>Generating QR…</div>
+        <script>
+          (function poll(){
+            var box = document.getElementById('qr-pending');
+            // link expired, slot closed or a server error: say so instead of spinning forever
+            function failed(){ box.innerHTML = "QR unavailable — <a href='/admin'>reload</a>"; }
+            fetch('/admin/qr_status').then(function(r){
+              if (r.status === 200) { r.text().then(function(svg){ box.innerHTML = svg; }); }
+              else if (r.status === 202) { setTimeout(poll, 300); }
+              else { failed(); }
+            }, failed);
+          })();
+        </script>
+        {% endif %}
         <div>
           <p><b>Slot:</b> {{active_slot}}</p>
           <p><a href='{{token_info.link}}' target='_blank'>Open student link</a></p>
           <p><button class='btn btn-sm btn-outline-light' onclick='navigator.clipboard.writeText("{{token_info.link}}")'>Copy link</button></p>
-          <p class='small-muted'>Generated at: {{token_info.created_at}}</p>
+          <p class='small-muted'>Valid until (UTC): {{token_info.expires_at}}</p>
         </div>
       </div>
     {% endif %}
@@ -250,80 +707,134 @@ SUBMIT_HTML = """
 VIEW_HTML = """
 <div class='card p-3'>
   <h4>Attendance Records</h4>
-  <div class='table-responsive small mt-3'>{{table | safe}}</div>
+  <form method='get' class='d-flex gap-2 mt-2'>
+    <input name='slot' class='form-control form-control-sm' placeholder='(optional) filter by slot' value='{{slot or ""}}'>
+    <button class='btn btn-sm btn-outline-light'>Filter</button>
+  </form>
+  <div class='table-responsive small mt-3'>
+    <table class='table table-dark table-sm'>
+      <thead><tr>{% for col in cols %}<th>{{col}}</th>{% endfor %}</tr></thead>
+      <tbody>
+      {% for row in rows %}<tr>{% for v in row %}<td>{{v}}</td>{% endfor %}</tr>{% endfor %}
+      </tbody>
+    </table>
+  </div>
+  <p class='small-muted'>Page {{page_no}} ({{size}} per page, newest first)</p>
+  <div class='d-flex gap-2'>
+    {% if prev_url %}<a href='{{prev_url}}' class='btn btn-sm btn-outline-light'>Newer</a>{% endif %}
+    {% if next_url %}<a href='{{next_url}}' class='btn btn-sm btn-outline-light'>Older</a>{% endif %}
+  </div>
   <a href='/admin' class='btn btn-sm btn-outline-light mt-3'>Back</a>
 </div>
 """
 
 # --------- RENDER HELP -----------
-def page(html, **ctx):
-    inner = render_template_string(html, **ctx)
-    return render_template_string(BASE_HTML, content=inner)
+# templates are compiled once at import; each page extends the BASE_HTML
+# layout, so a response is a single render pass
+_BASE_TMPL = app.jinja_env.from_string(BASE_HTML)
+
+def compile_page(html):
+    return app.jinja_env.from_string("{% extends layout %}{% block content %}" + html + "{% endblock %}",
+                                     globals={"layout": _BASE_TMPL})
+
+STUDENT_TMPL = compile_page(STUDENT_HTML)
+ADMIN_LOGIN_TMPL = compile_page(ADMIN_LOGIN_HTML)
+ADMIN_DASH_TMPL = compile_page(ADMIN_DASH_HTML)
+SUBMIT_TMPL = compile_page(SUBMIT_HTML)
+VIEW_TMPL = compile_page(VIEW_HTML)
+
+def page(tmpl, **ctx):
+    return tmpl.render(**ctx)
+
+# --------- AUTH ----------
+def require_admin(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not session.get("admin"):
+            return redirect(url_for("admin_login"))
+        return fn(*args, **kwargs)
+    return wrapper
 
 # --------- ROUTES ----------
 @app.route("/")
 def student_index():
     active = get_setting("active_slot")
-    token_row = get_token_for_slot(active) if active else None
+    token_str = get_token_for_slot(active) if active else None
     token_info = None
-    if token_row:
-        token_str, created_at = token_row
-        link = f"{BASE_URL}/submit?token={token_str}"
+    if token_expiry(token_str):
+        link = SUBMIT_LINK_PREFIX + token_str
         token_info = {"link": link}
-    return page(STUDENT_HTML, active_slot=active, token_link=(token_info["link"] if token_info else None), ttl=QR_TTL_SECONDS)
+    return page(STUDENT_TMPL, active_slot=active, token_link=(token_info["link"] if token_info else None), ttl=QR_TTL_SECONDS)
 
 @app.route("/admin/login", methods=["GET","POST"])
 def admin_login():
     if request.method == "GET":
-        return page(ADMIN_LOGIN_HTML, error=None)
+        return page(ADMIN_LOGIN_TMPL, error=None)
     pwd = request.form.get("password","")
-    if pwd == ADMIN_PASSWORD:
+    # constant-time; bytes so non-ASCII input cannot raise TypeError
+    if hmac.compare_digest(pwd.encode(), _ADMIN_PASSWORD_B):
         session["admin"] = True
         return redirect(url_for("admin"))
-    return page(ADMIN_LOGIN_HTML, error="Wrong password")
+    return page(ADMIN_LOGIN_TMPL, error="Wrong password")
 
 @app.route("/admin")
+@require_admin
 def admin():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
     active = get_setting("active_slot")
-    token_row = get_token_for_slot(active) if active else None
+    token_str = get_token_for_slot(active) if active else None
+    expires = token_expiry(token_str)
     token_info = None
-    if token_row:
-        token_str, created_at = token_row
-        link = f"{BASE_URL}/submit?token={token_str}"
-        buf = io.BytesIO(); qrcode.make(link).save(buf, format="PNG")
-        qr_b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-        token_info = {"link": link, "qr_b64": qr_b64, "created_at": created_at}
-    return page(ADMIN_DASH_HTML, active_slot=active, token_info=token_info)
+    if expires:
+        link = SUBMIT_LINK_PREFIX + token_str
+        token_info = {"link": link, "qr_svg": qr_svg(active, token_str, link),
+                      "expires_at": datetime.utcfromtimestamp(expires).isoformat()}
+    return page(ADMIN_DASH_TMPL, active_slot=active, token_info=token_info)
 
 @app.route("/admin/activate", methods=["POST"])
+@require_admin
 def admin_activate():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
     slot = request.form.get("slot","").strip()
     if slot:
         set_setting("active_slot", slot)
     return redirect(url_for("admin"))
 
 @app.route("/admin/deactivate", methods=["POST"])
+@require_admin
 def admin_deactivate():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
+    active = get_setting("active_slot")
     clear_setting("active_slot")
+    if active:
+        forget_submissions(active)
     return redirect(url_for("admin"))
 
 @app.route("/admin/generate", methods=["POST"])
+@require_admin
 def admin_generate():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
     active = get_setting("active_slot")
     if not active:
-        return page(ADMIN_DASH_HTML, active_slot=None, token_info=None)
+        return page(ADMIN_DASH_TMPL, active_slot=None, token_info=None)
+    expires = token_expiry(get_token_for_slot(active))
+    # current link still has a few seconds left: keep it (and its cached QR)
+    if expires and expires - time.time() > 5:
+        return redirect(url_for("admin"))
     token = make_token(active)
     store_token(token, active)
+    # render the QR while the browser follows the redirect
+    start_qr(token, SUBMIT_LINK_PREFIX + token)
     return redirect(url_for("admin"))
 
+@app.route("/admin/qr_status")
+@require_admin
+def admin_qr_status():
+    active = get_setting("active_slot")
+    token_str = get_token_for_slot(active) if active else None
+    if not token_expiry(token_str):
+        return "No active link", 404
+    svg = qr_svg(active, token_str, SUBMIT_LINK_PREFIX + token_str)
+    if svg is None:
+        return "", 202
+    return svg, 200, {"Content-Type": "image/svg+xml"}
+
 @app.route("/submit", methods=["GET","POST"])
 def submit():
     token = request.args.get("token") or request.form.get("token")
@@ -331,53 +842,63 @@ def submit():
         return "Missing token", 400
     try:
         data = decode_token(token)
-    except SignatureExpired:
+    except TokenExpired:
         return "Token expired", 400
-    except BadSignature:
+    except BadToken:
         return "Invalid token", 400
     slot = data.get("slot")
-    # ensure teacher actually generated this token
-    token_row = get_token_for_slot(slot)
-    if not token_row or token_row[0] != token:
+    # the slot must still be open and this must be its current link;
+    # both reads are served from the lookup cache
+    if get_setting("active_slot") != slot or get_token_for_slot(slot) != token:
         return "This attendance link is not active. Ask your teacher.", 403
     if request.method == "GET":
-        return page(SUBMIT_HTML, slot=slot, error=None, token=token)
+        return page(SUBMIT_TMPL, slot=slot, error=None, token=token)
     # POST -> require teacher PIN
     student_name = request.form.get("student_name","").strip()
     roll = request.form.get("roll","").strip()
     teacher_pin = request.form.get("teacher_pin","").strip()
-    if teacher_pin != TEACHER_PIN:
-        return page(SUBMIT_HTML, slot=slot, error="Incorrect Teacher PIN", token=token)
-    device_cid = make_device_cid(request)
-    df = query_records(slot=slot)
-    if not df.empty and not df[df["device_cid"] == device_cid].empty:
+    if not hmac.compare_digest(teacher_pin.encode(), _TEACHER_PIN_B):
+        return page(SUBMIT_TMPL, slot=slot, error="Incorrect Teacher PIN", token=token)
+    ip = request.remote_addr or ""
+    ua = request.headers.get("User-Agent", "")
+    device_cid = make_device_cid(ip, ua)
+    if insert_record(student_name, roll, slot, device_cid, ip, ua) == 0:
         return "Attendance already recorded from this device for this slot.", 400
-    insert_record(student_name, roll, slot, device_cid, request.remote_addr or "", request.headers.get("User-Agent",""))
     return f"Attendance recorded for {student_name} (roll {roll}) for slot {slot}."
 
 @app.route("/admin/view")
+@require_admin
 def admin_view():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
-    df = query_records(admin_view=True)
-    table = df.to_html(index=False, classes="table table-dark table-sm")
-    return page(VIEW_HTML, table=table)
+    slot = request.args.get("slot","").strip() or None
+    page_no = min(max(request.args.get("page", 1, type=int), 1), VIEW_MAX_PAGE)
+    size = min(max(request.args.get("size", VIEW_PAGE_SIZE, type=int), 1), VIEW_MAX_PAGE_SIZE)
+    version, key = data_version(), (slot, page_no, size)
+    html = view_cache_get(version, key)
+    if html is None:
+        # one extra row tells whether an older page exists
+        rows = list_records(slot=slot, limit=size + 1, offset=(page_no - 1) * size)
+        prev_url = url_for("admin_view", slot=slot, page=page_no - 1, size=size) if page_no > 1 else None
+        next_url = url_for("admin_view", slot=slot, page=page_no + 1, size=size) if len(rows) > size and page_no < VIEW_MAX_PAGE else None
+        html = page(VIEW_TMPL, cols=VIEW_COLS, rows=rows[:size], slot=slot,
+                    page_no=page_no, size=size, prev_url=prev_url, next_url=next_url)
+        view_cache_put(version, key, html)
+    return html
 
 @app.route("/admin/export")
+@require_admin
 def admin_export():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
-    df = query_records()  # full export
-    buf = io.BytesIO(); df.to_excel(buf, index=False); buf.seek(0)
-    resp = make_response(buf.read())
-    resp.headers["Content-Type"] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    resp.headers["Content-Disposition"] = "attachment; filename=attendance.xlsx"
-    return resp
+    # build_export is a no-op when a file for the current version exists
+    try:
+        f = open(build_export(), "rb")
+    except FileNotFoundError:
+        # another worker finished a newer export and removed this one
+        f = open(build_export(), "rb")
+    return send_file(f, as_attachment=True, download_name="attendance.xlsx",
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 @app.route("/admin/clear", methods=["POST"])
+@require_admin
 def admin_clear():
-    if not session.get("admin"):
-        return redirect(url_for("admin_login"))
     action = request.form.get("action")
     slot = request.form.get("slot","").strip()
     if action == "clear_all":
@@ -389,4 +910,6 @@ def admin_clear():
 # --------- START ----------
 if __name__ == "__main__":
     init_db()
+    cleanup_exports()
+    start_token_cleanup()
     app.run(debug=True)